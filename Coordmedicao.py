@@ -3,14 +3,33 @@ import pandas as pd
 import folium
 from streamlit_folium import st_folium
 import io
+import os
 import numpy as np
 from geopy.distance import geodesic
 from datetime import datetime, timedelta
 import random
 import plotly.express as px
 from folium import plugins
+from branca.element import MacroElement
+from jinja2 import Template
 import zipfile
 import openpyxl
+import sqlite3
+import hashlib
+
+# Histórico local de medições
+HISTORY_DB_PATH = os.environ.get(
+    'REZENDE_HISTORY_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rezende_historico.db')
+)
+HISTORY_BUCKET_DEG = 0.01  # tamanho da célula da grade de regiões (~1,1 km)
+
+# Pirâmide de densidade
+DENSITY_BASE_BINS = 256  # resolução da grade mais fina (células por eixo)
+DENSITY_LEVELS = 5
+DENSITY_HEAT_RADIUS_PX = 12  # raio do HeatMap; o nível exibido tem células deste tamanho na tela
+DENSITY_CHART_LEVEL = 2  # nível da pirâmide exibido no gráfico de densidade
+DENSITY_EXTENT_PERCENTILES = (0.5, 99.5)  # pontos fora desta faixa não definem nem entram na grade
 
 # Configuração da página
 st.set_page_config(
@@ -220,7 +239,98 @@ def validate_coordinates(df):
     return validation_results
 
 
-def create_map_with_enhanced_features(df):
+@st.cache_data
+def build_density_pyramid(lat, lon, base_bins=DENSITY_BASE_BINS, levels=DENSITY_LEVELS):
+    """Agrega os pontos em uma pirâmide de grades de densidade (da mais fina à mais grossa)"""
+    # Projeção Web Mercator (metros) para células de tamanho uniforme
+    x = np.radians(lon) * 6378137.0
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * 6378137.0
+
+    # Extensão por percentis, para que pontos isolados (ex.: 0,0) não inflem as células
+    low, high = DENSITY_EXTENT_PERCENTILES
+    x_min, x_max = np.percentile(x, low, method='lower'), np.percentile(x, high, method='higher')
+    y_min, y_max = np.percentile(y, low, method='lower'), np.percentile(y, high, method='higher')
+
+    # Grade quadrada centrada nos pontos, com extensão mínima para evitar divisão por zero
+    half_span = max(x_max - x_min, y_max - y_min, 100.0) / 2 * 1.01
+    x_center = (x_max + x_min) / 2
+    y_center = (y_max + y_min) / 2
+    grid_range = [[x_center - half_span, x_center + half_span],
+                  [y_center - half_span, y_center + half_span]]
+
+    # Pontos fora da grade são descartados (histogram2d já os ignora com range explícito)
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=base_bins, range=grid_range)
+
+    # Escala aproximada do Mercator na latitude central
+    scale = np.cos(np.radians(np.mean(lat)))
+
+    pyramid = []
+    for level in range(levels):
+        if level > 0:
+            # Nível mais grosso: soma de blocos 2x2 do nível anterior, sem revisitar os pontos
+            n = counts.shape[0] // 2
+            counts = counts[:n * 2, :n * 2].reshape(n, 2, n, 2).sum(axis=(1, 3))
+            x_edges = x_edges[::2]
+            y_edges = y_edges[::2]
+
+        x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+        y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+        cell_lats = np.degrees(2 * np.arctan(np.exp(y_centers / 6378137.0)) - np.pi / 2)
+        cell_lons = np.degrees(x_centers / 6378137.0)
+        ix, iy = np.nonzero(counts)
+        weights = counts[ix, iy] / counts.max()
+
+        pyramid.append({
+            'counts': counts,
+            'cell_lats': cell_lats,
+            'cell_lons': cell_lons,
+            'cell_size_m': (x_edges[1] - x_edges[0]) * scale,
+            'heat_points': np.column_stack([cell_lats[iy], cell_lons[ix], weights]).tolist(),
+        })
+
+    return pyramid
+
+
+class DensityLevelSwitcher(MacroElement):
+    """Exibe, a cada zoom, o nível da pirâmide cujas células têm o tamanho do raio do HeatMap"""
+    _template = Template('''
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var group = {{ this.group.get_name() }};
+            var layers = [{% for layer in this.layers %}{{ layer.get_name() }}{% if not loop.last %}, {% endif %}{% endfor %}];
+            var cellSizes = {{ this.cell_sizes | tojson }};
+
+            function updateDensityLevel() {
+                var metersPerPixel = 156543.03392 * Math.cos(map.getCenter().lat * Math.PI / 180) / Math.pow(2, map.getZoom());
+                var best = 0;
+                for (var i = 1; i < cellSizes.length; i++) {
+                    if (Math.abs(Math.log(cellSizes[i] / metersPerPixel / {{ this.radius }})) <
+                        Math.abs(Math.log(cellSizes[best] / metersPerPixel / {{ this.radius }}))) {
+                        best = i;
+                    }
+                }
+                layers.forEach(function(layer, i) {
+                    if (i === best) { group.addLayer(layer); } else { group.removeLayer(layer); }
+                });
+            }
+
+            map.on('zoomend', updateDensityLevel);
+            updateDensityLevel();
+        })();
+        {% endmacro %}
+    ''')
+
+    def __init__(self, group, layers, cell_sizes, radius):
+        super().__init__()
+        self._name = 'DensityLevelSwitcher'
+        self.group = group
+        self.layers = layers
+        self.cell_sizes = cell_sizes
+        self.radius = radius
+
+
+def create_map_with_enhanced_features(df, density_pyramid=None):
     """Cria o mapa com funcionalidades avançadas e tema Rezende Energia"""
     center_lat = df['BA'].mean()
     center_lon = df['BB'].mean()
@@ -307,6 +417,30 @@ def create_map_with_enhanced_features(df):
         }
     ).add_to(m)
 
+    # Camada de densidade: todos os níveis da pirâmide vão para o mapa e o zoom escolhe qual exibir
+    if density_pyramid is not None:
+        density_layer = folium.FeatureGroup(name='Mapa de Densidade', show=True)
+        heat_layers = []
+        for grid in density_pyramid:
+            heat_layer = plugins.HeatMap(
+                grid['heat_points'],
+                min_opacity=0.3,
+                max_zoom=0,  # sem atenuação por zoom: os pesos já vêm normalizados por nível
+                radius=DENSITY_HEAT_RADIUS_PX,
+                blur=DENSITY_HEAT_RADIUS_PX * 0.75,
+                gradient={0.2: '#FFB84D', 0.5: '#F7931E', 0.8: '#FF6B35', 1.0: '#000000'},
+                control=False
+            )
+            heat_layer.add_to(density_layer)
+            heat_layers.append(heat_layer)
+        density_layer.add_to(m)
+        m.add_child(DensityLevelSwitcher(
+            density_layer,
+            heat_layers,
+            [grid['cell_size_m'] for grid in density_pyramid],
+            DENSITY_HEAT_RADIUS_PX
+        ))
+
     folium.LayerControl(position='topright').add_to(m)
 
     minimap = plugins.MiniMap(
@@ -397,6 +531,155 @@ def create_kmz_file(df):
     return kmz_buffer.getvalue()
 
 
+def get_history_connection(db_path=HISTORY_DB_PATH):
+    """Abre (e cria, se necessário) o banco SQLite local com o histórico de medições"""
+    # Uma conexão por sessão; a concorrência entre sessões fica com o lock de arquivo do SQLite
+    if 'history_conn' in st.session_state:
+        return st.session_state['history_conn']
+
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT,
+            uploaded_at TEXT NOT NULL,
+            n_points INTEGER NOT NULL,
+            content_hash TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS measurements (
+            upload_id INTEGER NOT NULL REFERENCES uploads(id),
+            measured_at TEXT NOT NULL,
+            ah TEXT,
+            ba REAL NOT NULL,
+            bb REAL NOT NULL,
+            bucket_lat INTEGER NOT NULL,
+            bucket_lon INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_measurements_bucket
+            ON measurements (bucket_lat, bucket_lon, measured_at);
+        CREATE INDEX IF NOT EXISTS idx_measurements_ah
+            ON measurements (ah, upload_id, measured_at);
+        DROP INDEX IF EXISTS idx_measurements_time;
+    ''')
+    st.session_state['history_conn'] = conn
+    return conn
+
+
+def normalize_house_id(value):
+    """Padroniza o número da casa (AH) para que a mesma casa tenha a mesma chave em todo upload"""
+    if pd.isna(value):
+        return None
+    # 1, 1.0 e '1.0' (AH numérico, com lacunas ou mantido como texto) viram todos '1'
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return str(int(number)) if number.is_integer() else text
+
+
+def append_to_history(conn, df, file_name):
+    """Registra no histórico os pontos válidos de uma planilha processada (ignora planilhas já registradas)"""
+    measured_at = datetime.now().isoformat(timespec='seconds')
+    ah = df['AH'].map(normalize_house_id)
+    ba = df['BA'].to_numpy(dtype=float)
+    bb = df['BB'].to_numpy(dtype=float)
+    bucket_lat = np.floor(ba / HISTORY_BUCKET_DEG).astype(int)
+    bucket_lon = np.floor(bb / HISTORY_BUCKET_DEG).astype(int)
+
+    content_hash = hashlib.sha256(
+        pd.DataFrame({'AH': ah, 'BA': ba, 'BB': bb}).to_csv(index=False).encode('utf-8')
+    ).hexdigest()
+
+    with conn:
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO uploads (file_name, uploaded_at, n_points, content_hash) VALUES (?, ?, ?, ?)',
+            (file_name, measured_at, len(df), content_hash)
+        )
+        if cursor.rowcount == 0:
+            return None
+        upload_id = cursor.lastrowid
+        conn.executemany(
+            'INSERT INTO measurements (upload_id, measured_at, ah, ba, bb, bucket_lat, bucket_lon) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            zip([upload_id] * len(df), [measured_at] * len(df), ah.tolist(),
+                ba.tolist(), bb.tolist(), bucket_lat.tolist(), bucket_lon.tolist())
+        )
+    return upload_id
+
+
+def query_points_per_period(conn, period='dia'):
+    """Quantidade de pontos medidos por dia/semana em cada região (célula da grade)"""
+    period_format = '%Y-%W' if period == 'semana' else '%Y-%m-%d'
+    result = pd.read_sql_query(
+        'SELECT strftime(?, measured_at) AS periodo, bucket_lat, bucket_lon, COUNT(*) AS pontos '
+        'FROM measurements GROUP BY periodo, bucket_lat, bucket_lon ORDER BY periodo',
+        conn, params=(period_format,)
+    )
+    result['regiao'] = (
+        (result['bucket_lat'] * HISTORY_BUCKET_DEG).round(2).astype(str) + ', ' +
+        (result['bucket_lon'] * HISTORY_BUCKET_DEG).round(2).astype(str)
+    )
+    return result[['periodo', 'regiao', 'pontos']]
+
+
+def query_moved_houses(conn, min_distance_m):
+    """Casas cujas coordenadas se deslocaram mais de X metros entre medições consecutivas"""
+    # Pré-filtro no SQL: um deslocamento de X m exige variação >= X/√2 m em latitude ou longitude
+    min_delta_deg = min_distance_m / (111320.0 * np.sqrt(2))
+    # Uma linha por casa e upload (a primeira da planilha), para comparar apenas uploads diferentes
+    candidates = pd.read_sql_query('''
+        WITH per_upload AS (
+            SELECT ah, upload_id, measured_at, ba, bb
+            FROM measurements
+            WHERE rowid IN (
+                SELECT MIN(rowid) FROM measurements
+                WHERE ah IS NOT NULL
+                GROUP BY ah, upload_id
+            )
+        )
+        SELECT * FROM (
+            SELECT ah, upload_id, measured_at, ba, bb,
+                   LAG(measured_at) OVER w AS prev_measured_at,
+                   LAG(ba) OVER w AS prev_ba,
+                   LAG(bb) OVER w AS prev_bb
+            FROM per_upload
+            WINDOW w AS (PARTITION BY ah ORDER BY measured_at, upload_id)
+        )
+        WHERE prev_ba IS NOT NULL
+          AND (ABS(ba - prev_ba) >= ? OR ABS(bb - prev_bb) >= ?)
+    ''', conn, params=(min_delta_deg, min_delta_deg))
+
+    candidates['deslocamento_m'] = haversine_m(
+        candidates['prev_ba'].to_numpy(), candidates['prev_bb'].to_numpy(),
+        candidates['ba'].to_numpy(), candidates['bb'].to_numpy()
+    )
+    moved = candidates[candidates['deslocamento_m'] > min_distance_m]
+    return moved.sort_values('deslocamento_m', ascending=False).reset_index(drop=True)
+
+
+def query_coverage_growth(conn):
+    """Crescimento acumulado da cobertura (células da grade já medidas) ao longo do tempo"""
+    first_seen = pd.read_sql_query('''
+        SELECT dia, COUNT(*) AS novas_celulas FROM (
+            SELECT date(MIN(measured_at)) AS dia
+            FROM measurements
+            GROUP BY bucket_lat, bucket_lon
+        )
+        GROUP BY dia ORDER BY dia
+    ''', conn)
+    first_seen['celulas_cobertas'] = first_seen['novas_celulas'].cumsum()
+    return first_seen
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Distância em metros entre pares de coordenadas (vetorizado)"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
 if uploaded_file is not None:
     try:
         # Ler o arquivo
@@ -485,6 +768,16 @@ if uploaded_file is not None:
                     f'<div style="background: linear-gradient(45deg, #28a745, #20c997); color: white; padding: 1rem; border-radius: 8px; text-align: center; font-weight: bold;">🎉 {len(df_valid)} COORDENADAS PROCESSADAS COM SUCESSO!</div>',
                     unsafe_allow_html=True)
 
+                # Registrar no histórico uma vez por arquivo na sessão (planilhas repetidas são ignoradas pelo banco)
+                registered_uploads = st.session_state.setdefault('registered_uploads', set())
+                upload_key = getattr(uploaded_file, 'file_id', f"{uploaded_file.name}_{uploaded_file.size}")
+                if upload_key not in registered_uploads:
+                    try:
+                        append_to_history(get_history_connection(), df_valid, uploaded_file.name)
+                        registered_uploads.add(upload_key)
+                    except sqlite3.Error as e:
+                        st.warning(f"⚠️ Não foi possível registrar a planilha no histórico de medições: {e}")
+
                 # Preview dos dados
                 st.markdown('<div class="section-header">📋 PREVIEW DOS DADOS PROCESSADOS</div>', unsafe_allow_html=True)
                 st.dataframe(df_valid.head(10), use_container_width=True)
@@ -498,8 +791,11 @@ if uploaded_file is not None:
                     st.markdown('<div class="section-header">🗺️ MAPA INTERATIVO - REZENDE ENERGIA</div>',
                                 unsafe_allow_html=True)
 
+                    density_pyramid = build_density_pyramid(df_valid['BA'].to_numpy(dtype=float),
+                                                            df_valid['BB'].to_numpy(dtype=float))
+
                     with st.spinner("⚡ Gerando mapa profissional Rezende Energia..."):
-                        map_obj = create_map_with_enhanced_features(df_valid)
+                        map_obj = create_map_with_enhanced_features(df_valid, density_pyramid)
                         st_folium(map_obj, width="100%", height=600, returned_objects=["last_clicked"])
 
                     # Análises avançadas
@@ -616,6 +912,26 @@ if uploaded_file is not None:
                                 mime="application/vnd.google-earth.kmz"
                             )
 
+                    # Densidade
+                    density_level = density_pyramid[DENSITY_CHART_LEVEL]
+                    with st.expander("🔥 ANÁLISE DE DENSIDADE"):
+                        fig = px.imshow(
+                            density_level['counts'].T,
+                            x=density_level['cell_lons'],
+                            y=density_level['cell_lats'],
+                            origin='lower',
+                            title=f"Densidade de Pontos - Rezende Energia (células de ~{density_level['cell_size_m']:,.0f} m)",
+                            labels={'x': 'Longitude', 'y': 'Latitude', 'color': 'Pontos'},
+                            color_continuous_scale=['#FFFFFF', '#FFB84D', '#F7931E', '#000000']
+                        )
+                        fig.update_layout(
+                            height=500,
+                            plot_bgcolor='rgba(0,0,0,0)',
+                            paper_bgcolor='rgba(0,0,0,0)',
+                            font=dict(color='#000000')
+                        )
+                        st.plotly_chart(fig, use_container_width=True)
+
     except Exception as e:
         st.markdown(
             f'<div style="background: linear-gradient(45deg, #dc3545, #fd7e14); color: white; padding: 1.5rem; border-radius: 8px; text-align: center; font-weight: bold;">❌ ERRO NO PROCESSAMENTO: Verifique o formato do arquivo</div>',
@@ -676,6 +992,55 @@ else:
     </div>
     """, unsafe_allow_html=True)
 
+# Histórico de medições (independente de haver arquivo carregado)
+try:
+    history_uploads = (get_history_connection().execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+                       if os.path.exists(HISTORY_DB_PATH) else 0)
+except sqlite3.Error as e:
+    history_uploads = 0
+    st.warning(f"⚠️ Histórico de medições indisponível: {e}")
+
+if history_uploads > 0:
+    st.markdown('<div class="section-header">🕒 HISTÓRICO DE MEDIÇÕES</div>', unsafe_allow_html=True)
+
+    try:
+        tab1, tab2, tab3 = st.tabs(["📅 Pontos por Período", "📏 Casas Deslocadas", "📈 Crescimento da Cobertura"])
+
+        with tab1:
+            period = st.radio("Agrupar por", ["dia", "semana"], horizontal=True, key="history_period")
+            points_per_period = query_points_per_period(get_history_connection(), period)
+            st.dataframe(points_per_period, use_container_width=True)
+
+        with tab2:
+            min_distance = st.number_input("Deslocamento mínimo (m)", min_value=0.0, value=10.0,
+                                           step=1.0, key="history_min_distance")
+            moved_houses = query_moved_houses(get_history_connection(), min_distance)
+            if len(moved_houses) == 0:
+                st.info("Nenhuma casa com deslocamento acima do limite entre medições.")
+            else:
+                st.dataframe(moved_houses, use_container_width=True)
+
+        with tab3:
+            coverage = query_coverage_growth(get_history_connection())
+            fig = px.line(
+                coverage,
+                x='dia',
+                y='celulas_cobertas',
+                markers=True,
+                title="Crescimento da Cobertura - Rezende Energia",
+                labels={'dia': 'Data', 'celulas_cobertas': 'Regiões Cobertas'},
+                color_discrete_sequence=['#F7931E']
+            )
+            fig.update_layout(
+                height=400,
+                plot_bgcolor='rgba(0,0,0,0)',
+                paper_bgcolor='rgba(0,0,0,0)',
+                font=dict(color='#000000')
+            )
+            st.plotly_chart(fig, use_container_width=True)
+    except sqlite3.Error as e:
+        st.warning(f"⚠️ Erro ao consultar o histórico de medições: {e}")
+
 # Rodapé da empresa
 st.markdown("""
 <div class="company-footer">